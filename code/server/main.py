@@ -1,14 +1,25 @@
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from typing import Optional, List, Tuple
+from fastapi.responses import Response
+from typing import Optional, Dict, List, Tuple
 from pydantic import BaseModel
 import httpx
-import requests
+import numpy as np
+import orjson
 import os
 import asyncio
+import hashlib
+import math
+import urllib.parse
+from collections import Counter
+from operator import itemgetter
+from contextlib import asynccontextmanager
 from datetime import datetime
+from aiocache import Cache, SimpleMemoryCache
+from aiocache.serializers import NullSerializer
 from cachetools import TTLCache
 from dotenv import load_dotenv
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
 
 load_dotenv()
 
@@ -23,10 +34,32 @@ class NewsArticle(BaseModel):
     sentiment: Optional[str] = None
     sentiment_score: Optional[float] = None
 
+http_client: Optional[httpx.AsyncClient] = None
+local_sentiment_model = None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global http_client, local_sentiment_model
+    if SENTIMENT_MODEL["backend"] == "onnx":
+        local_sentiment_model = await asyncio.to_thread(load_local_sentiment_model)
+    http_client = httpx.AsyncClient(
+        http2=True,
+        timeout=30.0,
+        limits=httpx.Limits(max_keepalive_connections=50, max_connections=100)
+    )
+    try:
+        yield
+    finally:
+        await http_client.aclose()
+        http_client = None
+        local_sentiment_model = None
+        await cache.close()
+
 app = FastAPI(
     title="News Sentiment API",
     description="Real-time financial news sentiment analysis API",
-    version="2.1.0"
+    version="2.1.0",
+    lifespan=lifespan
 )
 
 app.add_middleware(
@@ -38,9 +71,33 @@ app.add_middleware(
 )
 
 NEWS_CACHE_TTL = 600
+MAX_NEWS_PAGES = 4
+STATS_PAGE_LIMIT = (1, 30)
 RATE_LIMIT_TTL = 10
-news_cache = TTLCache(maxsize=500, ttl=NEWS_CACHE_TTL)
-rate_limit_cache = TTLCache(maxsize=100, ttl=RATE_LIMIT_TTL)
+# Shared across workers when CACHE_URL points at Redis, e.g. redis://redis:6379/0
+CACHE_URL = os.getenv("CACHE_URL", "memory://")
+
+def create_cache(cache_url: str):
+    # Same URL handling as Cache.from_url, which cannot take a serializer or namespace
+    parsed_url = urllib.parse.urlparse(cache_url)
+    cache_class = Cache.get_scheme_class(parsed_url.scheme)
+    cache_options = dict(urllib.parse.parse_qsl(parsed_url.query))
+    if parsed_url.path:
+        cache_options.update(cache_class.parse_uri_path(parsed_url.path))
+    if parsed_url.hostname:
+        cache_options["endpoint"] = parsed_url.hostname
+    if parsed_url.port:
+        cache_options["port"] = parsed_url.port
+    if parsed_url.password:
+        cache_options["password"] = parsed_url.password
+    cache_options.setdefault("namespace", os.getenv("CACHE_NAMESPACE", "sentimentpulse:"))
+    # Cached news and stats are stored as pre-encoded JSON bytes
+    return Cache(cache_class, serializer=NullSerializer(encoding=None), **cache_options)
+
+cache = create_cache(CACHE_URL)
+SENTIMENT_CACHE_TTL = 3600
+sentiment_cache = TTLCache(maxsize=5000, ttl=SENTIMENT_CACHE_TTL)
+inflight_news_fetches: Dict[str, asyncio.Future] = {}
 
 # API configurations
 MARKETAUX_API = {
@@ -50,26 +107,162 @@ MARKETAUX_API = {
 
 HUGGINGFACE_API = {
     "url": "https://api-inference.huggingface.co/models/mrm8488/distilroberta-finetuned-financial-news-sentiment-analysis",
-    "token": os.getenv("HUGGINGFACE_API_TOKEN")
+    "token": os.getenv("HUGGINGFACE_API_TOKEN"),
+    "max_concurrency": 8,
+    "retry_status_codes": {429, 503}
+}
+huggingface_semaphore = asyncio.Semaphore(HUGGINGFACE_API["max_concurrency"])
+
+# Set SENTIMENT_BACKEND=onnx to score locally instead of calling the hosted API.
+# Install requirements-onnx.txt, then export and quantize the same model once with optimum:
+#   optimum-cli export onnx --model mrm8488/distilroberta-finetuned-financial-news-sentiment-analysis --task text-classification onnx/
+#   optimum-cli onnxruntime quantize --onnx_model onnx/ --avx2 -o onnx-int8/
+# The tokenizer and config are read from the export directory, the weights from the quantized one.
+SENTIMENT_MODEL = {
+    "backend": os.getenv("SENTIMENT_BACKEND", "huggingface"),
+    "onnx_path": os.getenv("SENTIMENT_ONNX_PATH", "onnx/"),
+    "quantized_path": os.getenv("SENTIMENT_ONNX_QUANTIZED_PATH", "onnx-int8/"),
+    "onnx_file": os.getenv("SENTIMENT_ONNX_FILE", "model_quantized.onnx")
 }
 
-async def get_sentiment(text: str) -> Tuple[str, float]:
-    try:
-        api_response = requests.post(
+SENTIMENT_LABELS = ("POSITIVE", "NEUTRAL", "NEGATIVE")
+SENTIMENT_IDS = {label: index for index, label in enumerate(SENTIMENT_LABELS)}
+SENTIMENT_MAPPING = {
+    "positive": "POSITIVE",
+    "neutral": "NEUTRAL",
+    "negative": "NEGATIVE"
+}
+SENTIMENT_SCORE_KEY = itemgetter('score')
+
+SENTIMENT_BATCH_SIZE = 32
+LOCAL_SENTIMENT_BATCH_SIZE = 16
+
+def parse_sentiment(scores) -> Tuple[str, float]:
+    sentiment_result = max(scores, key=SENTIMENT_SCORE_KEY)
+    return SENTIMENT_MAPPING.get(sentiment_result['label'].lower(), "NEUTRAL"), sentiment_result['score']
+
+def sentiment_cache_key(text: str) -> str:
+    return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+def is_retryable_huggingface_error(err: BaseException) -> bool:
+    return (
+        isinstance(err, httpx.HTTPStatusError)
+        and err.response.status_code in HUGGINGFACE_API["retry_status_codes"]
+    )
+
+@retry(
+    retry=retry_if_exception(is_retryable_huggingface_error),
+    wait=wait_exponential(multiplier=0.5, max=8),
+    stop=stop_after_attempt(4),
+    reraise=True
+)
+async def post_sentiment_request(client, texts: List[str]) -> httpx.Response:
+    async with huggingface_semaphore:
+        api_response = await client.post(
             HUGGINGFACE_API["url"],
             headers={"Authorization": f"Bearer {HUGGINGFACE_API['token']}"},
-            json={"inputs": text}
+            json={"inputs": texts},
+            timeout=30.0
         )
-        result = api_response.json()
-        sentiment_result = max(result[0], key=lambda x: x['score'])
-        sentiment_mapping = {
-            "positive": "POSITIVE",
-            "neutral": "NEUTRAL",
-            "negative": "NEGATIVE"
-        }
-        return sentiment_mapping.get(sentiment_result['label'].lower(), "NEUTRAL"), sentiment_result['score']
+    if api_response.status_code in HUGGINGFACE_API["retry_status_codes"]:
+        api_response.raise_for_status()
+    return api_response
+
+async def fetch_sentiment_chunk(client, texts: List[str]) -> Optional[List[Tuple[str, float]]]:
+    try:
+        api_response = await post_sentiment_request(client, texts)
+        result = orjson.loads(api_response.content)
+        if len(result) != len(texts):
+            raise ValueError("Unexpected number of sentiment results")
+        return [parse_sentiment(scores) for scores in result]
+    except Exception:
+        return None
+
+def load_local_sentiment_model():
+    from optimum.onnxruntime import ORTModelForSequenceClassification
+    from transformers import AutoConfig, AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(SENTIMENT_MODEL["onnx_path"])
+    model = ORTModelForSequenceClassification.from_pretrained(
+        SENTIMENT_MODEL["quantized_path"],
+        file_name=SENTIMENT_MODEL["onnx_file"],
+        config=AutoConfig.from_pretrained(SENTIMENT_MODEL["onnx_path"])
+    )
+    return tokenizer, model
+
+def run_local_sentiment(texts: List[str]) -> List[Tuple[str, float]]:
+    tokenizer, model = local_sentiment_model
+    labels = model.config.id2label
+    # Tokenize once, then score in length order so each mini-batch pads to a similar length
+    encodings = tokenizer(texts, truncation=True)
+    features = [
+        {name: values[index] for name, values in encodings.items()}
+        for index in range(len(texts))
+    ]
+    order = np.argsort([len(feature["input_ids"]) for feature in features], kind="stable")
+
+    sorted_sentiments = []
+    for start in range(0, len(order), LOCAL_SENTIMENT_BATCH_SIZE):
+        batch_features = [features[index] for index in order[start:start + LOCAL_SENTIMENT_BATCH_SIZE]]
+        inputs = tokenizer.pad(batch_features, padding="longest", return_tensors="np")
+        logits = np.asarray(model(**inputs).logits)
+        exp_logits = np.exp(logits - logits.max(axis=1, keepdims=True))
+        probabilities = exp_logits / exp_logits.sum(axis=1, keepdims=True)
+        sorted_sentiments.extend(
+            parse_sentiment([
+                {"label": labels[index], "score": float(score)}
+                for index, score in enumerate(row)
+            ])
+            for row in probabilities
+        )
+
+    inverse = np.argsort(order)
+    return [sorted_sentiments[index] for index in inverse]
+
+async def score_sentiment_chunk(client, texts: List[str]) -> Optional[List[Tuple[str, float]]]:
+    if local_sentiment_model is None:
+        return await fetch_sentiment_chunk(client, texts)
+    try:
+        return await asyncio.to_thread(run_local_sentiment, texts)
     except Exception:
-        return "NEUTRAL", 0.5
+        return None
+
+async def get_sentiments_batch(client, texts: List[str]) -> List[Tuple[str, float]]:
+    cache_keys = [sentiment_cache_key(text) for text in texts]
+    sentiments = {}
+    uncached_texts = {}
+    for cache_key, text in zip(cache_keys, texts):
+        cached_sentiment = sentiment_cache.get(cache_key)
+        if cached_sentiment is not None:
+            sentiments[cache_key] = cached_sentiment
+        else:
+            uncached_texts.setdefault(cache_key, text)
+
+    pending_keys = list(uncached_texts)
+    # The local model mini-batches internally; the hosted API is chunked here.
+    batch_size = SENTIMENT_BATCH_SIZE if local_sentiment_model is None else max(len(pending_keys), 1)
+    chunks = [
+        pending_keys[start:start + batch_size]
+        for start in range(0, len(pending_keys), batch_size)
+    ]
+    chunk_results = await asyncio.gather(
+        *(score_sentiment_chunk(client, [uncached_texts[key] for key in chunk]) for chunk in chunks)
+    )
+
+    for chunk, chunk_result in zip(chunks, chunk_results):
+        if chunk_result is None:
+            continue
+        for cache_key, sentiment in zip(chunk, chunk_result):
+            sentiment_cache[cache_key] = sentiment
+            sentiments[cache_key] = sentiment
+
+    return [sentiments.get(cache_key, ("NEUTRAL", 0.5)) for cache_key in cache_keys]
+
+def parse_published_at(published_at: str) -> float:
+    try:
+        return datetime.fromisoformat(published_at.replace("Z", "+00:00")).timestamp()
+    except (AttributeError, ValueError):
+        return 0.0
 
 def transform_news_data(marketaux_response):
     transformed_articles = []
@@ -86,6 +279,7 @@ def transform_news_data(marketaux_response):
             "source": article["source"],
             "url": article["url"],
             "publishedAt": article["published_at"],
+            "publishedAt_ts": parse_published_at(article["published_at"]),
             "relatedSymbols": related_symbols
         })
     return transformed_articles
@@ -102,30 +296,114 @@ async def fetch_news_page(client, symbols: Optional[str], page: int, limit: int)
         }
         response = await client.get(f"{MARKETAUX_API['base_url']}/news/all", params=request_params)
         response.raise_for_status()
-        return response.json()
+        return orjson.loads(response.content)
     except Exception:
         return None
 
-async def fetch_all_news_pages(symbols: Optional[str], base_limit: int = 10):
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        fetch_tasks = [
-            fetch_news_page(client, symbols, page, base_limit)
-            for page in range(1, 5)
-        ]
-        api_results = await asyncio.gather(*fetch_tasks)
+def count_news_pages(first_page, base_limit: int) -> int:
+    if not first_page or 'data' not in first_page:
+        return 1
+    meta = first_page.get("meta") or {}
+    if meta.get("found") is None:
+        return MAX_NEWS_PAGES
+    # Marketaux may cap the page size below what we asked for
+    page_size = meta.get("limit") or base_limit or 1
+    pages_available = math.ceil(meta["found"] / page_size)
+    pages_wanted = math.ceil(base_limit * MAX_NEWS_PAGES / page_size)
+    return max(1, min(MAX_NEWS_PAGES, pages_available, pages_wanted))
 
-        combined_news = []
-        for result in api_results:
-            if result and 'data' in result:
-                news_data = transform_news_data(result)
-                for article in news_data:
-                    sentiment_text = f"{article['title']}. {article['description']}"
-                    sentiment_label, sentiment_score = await get_sentiment(sentiment_text)
-                    article["sentiment"] = sentiment_label
-                    article["sentiment_score"] = sentiment_score
-                combined_news.extend(news_data)
+async def fetch_all_news_pages(symbols: Optional[str], base_limit: int = 10):
+    client = http_client
+    first_page = await fetch_news_page(client, symbols, 1, base_limit)
+    fetch_tasks = [
+        fetch_news_page(client, symbols, page, base_limit)
+        for page in range(2, count_news_pages(first_page, base_limit) + 1)
+    ]
+    api_results = [first_page, *await asyncio.gather(*fetch_tasks)]
+
+    combined_news = []
+    for result in api_results:
+        if result and 'data' in result:
+            combined_news.extend(transform_news_data(result))
+
+    # Score every page in a single batch so chunking and the semaphore span pages
+    sentiment_texts = [
+        f"{article['title']}. {article['description']}"
+        for article in combined_news
+    ]
+    sentiment_results = await get_sentiments_batch(client, sentiment_texts)
+    for article, (sentiment_label, sentiment_score) in zip(combined_news, sentiment_results):
+        article["sentiment"] = sentiment_label
+        article["sentiment_score"] = sentiment_score
+
+    combined_news.sort(key=itemgetter("publishedAt_ts"), reverse=True)
+    # publishedAt_ts is only a sort key; keep it out of the response payload
+    for article in combined_news:
+        del article["publishedAt_ts"]
+    return combined_news
+
+async def fetch_and_cache_news(symbols: Optional[str], page: int, limit: int, base_limit: int) -> Optional[bytes]:
+    fetched_news = await fetch_all_news_pages(symbols, base_limit)
+    if not fetched_news:
+        return None
+    return await cache_news(symbols, page, limit, fetched_news)
+
+async def fetch_latest_news(symbols: Optional[str], page: int, limit: int, base_limit: int) -> Optional[bytes]:
+    # Concurrent cache misses for the same cache key share one fetch and one cache write,
+    # which completes even if every waiting client disconnects
+    fetch_key = f"{symbols}:{page}:{limit}:{base_limit}"
+    fetch_task = inflight_news_fetches.get(fetch_key)
+    if fetch_task is None:
+        fetch_task = asyncio.ensure_future(fetch_and_cache_news(symbols, page, limit, base_limit))
+        inflight_news_fetches[fetch_key] = fetch_task
+        fetch_task.add_done_callback(lambda task: finish_news_fetch(fetch_key, task))
+    return await asyncio.shield(fetch_task)
+
+def finish_news_fetch(fetch_key: str, fetch_task: asyncio.Future):
+    inflight_news_fetches.pop(fetch_key, None)
+    # Retrieve the exception so an unawaited failure is not logged as never retrieved
+    if not fetch_task.cancelled():
+        fetch_task.exception()
+
+async def acquire_rate_limit(rate_limit_key: str) -> bool:
+    try:
+        await cache.add(rate_limit_key, datetime.now().isoformat(), ttl=RATE_LIMIT_TTL)
+        return True
+    except ValueError:
+        return False
+
+async def cache_news(symbols: Optional[str], page: int, limit: int, fetched_news) -> bytes:
+    news_payload = orjson.dumps(fetched_news)
+    await cache.set(f"news:{symbols}:{page}:{limit}", news_payload, ttl=NEWS_CACHE_TTL)
+    # /api/stats only ever reads the default page/limit
+    if (page, limit) == STATS_PAGE_LIMIT:
+        stats_payload = orjson.dumps(compute_news_stats(fetched_news))
+        await cache.set(f"stats:{symbols}", stats_payload, ttl=NEWS_CACHE_TTL)
+    return news_payload
+
+def json_response(payload: bytes) -> Response:
+    return Response(content=payload, media_type="application/json")
+
+def compute_news_stats(news_data):
+    sentiment_ids = np.fromiter(
+        (SENTIMENT_IDS[article["sentiment"]] for article in news_data),
+        dtype=np.int8,
+        count=len(news_data)
+    )
+    sentiment_counts = np.bincount(sentiment_ids, minlength=len(SENTIMENT_LABELS))
+    source_counts = Counter(article["source"] for article in news_data)
+    symbol_counts = Counter(
+        symbol
+        for article in news_data
+        for symbol in article["relatedSymbols"]
+    )
 
-        return combined_news
+    return {
+        "total_articles": len(news_data),
+        "sentiment_distribution": dict(zip(SENTIMENT_LABELS, sentiment_counts.tolist())),
+        "top_sources": dict(source_counts.most_common(5)),
+        "top_symbols": dict(symbol_counts.most_common(5))
+    }
 
 @app.get("/")
 async def root():
@@ -141,32 +419,27 @@ async def health_check():
     return {
         "status": "healthy",
         "timestamp": datetime.now().isoformat(),
-        "cache_size": len(news_cache),
-        "rate_limit_cache_size": len(rate_limit_cache)
+        "cache_backend": CACHE_URL.split("://", 1)[0]
     }
 
-@app.get("/api/news")
+@app.get("/api/news", response_model=None)
 async def get_news(symbols: Optional[str] = None, page: int = 1, limit: int = 30):
     try:
         rate_limit_key = f"rate_limit:{symbols or 'general'}"
-        if rate_limit_key in rate_limit_cache:
+        if not await acquire_rate_limit(rate_limit_key):
             raise HTTPException(
                 status_code=429,
                 detail="Too many requests. Please wait 10 seconds between requests."
             )
 
-        rate_limit_cache[rate_limit_key] = datetime.now()
-        cache_key = f"news:{symbols}:{page}:{limit}"
-
-        if cache_key in news_cache:
-            return news_cache[cache_key]
+        cached_news = await cache.get(f"news:{symbols}:{page}:{limit}")
+        if cached_news is not None:
+            return json_response(cached_news)
 
-        fetched_news = await fetch_all_news_pages(symbols, limit // 3)
+        news_payload = await fetch_latest_news(symbols, page, limit, limit // 3)
 
-        if fetched_news:
-            fetched_news.sort(key=lambda x: x["publishedAt"], reverse=True)
-            news_cache[cache_key] = fetched_news
-            return fetched_news
+        if news_payload:
+            return json_response(news_payload)
 
         return []
 
@@ -175,24 +448,20 @@ async def get_news(symbols: Optional[str] = None, page: int = 1, limit: int = 30
     except Exception as err:
         raise HTTPException(status_code=500, detail=str(err))
 
-@app.get("/api/news/refresh")
+@app.get("/api/news/refresh", response_model=None)
 async def refresh_news(symbols: Optional[str] = None):
     try:
         rate_limit_key = f"rate_limit_refresh:{symbols or 'general'}"
-        if rate_limit_key in rate_limit_cache:
+        if not await acquire_rate_limit(rate_limit_key):
             raise HTTPException(
                 status_code=429,
                 detail="Too many requests. Please wait 10 seconds between refreshes."
             )
 
-        rate_limit_cache[rate_limit_key] = datetime.now()
-        fetched_news = await fetch_all_news_pages(symbols, 10)
+        news_payload = await fetch_latest_news(symbols, *STATS_PAGE_LIMIT, 10)
 
-        if fetched_news:
-            fetched_news.sort(key=lambda x: x["publishedAt"], reverse=True)
-            cache_key = f"news:{symbols}:1:30"
-            news_cache[cache_key] = fetched_news
-            return fetched_news
+        if news_payload:
+            return json_response(news_payload)
 
         return []
 
@@ -201,43 +470,42 @@ async def refresh_news(symbols: Optional[str] = None):
     except Exception as err:
         raise HTTPException(status_code=500, detail=str(err))
 
-@app.get("/api/stats")
+@app.get("/api/stats", response_model=None)
 async def get_stats(symbols: Optional[str] = None):
     try:
-        cache_key = f"news:{symbols}:1:30"
-        if cache_key not in news_cache:
+        news_stats = await cache.get(f"stats:{symbols}")
+        if news_stats is None:
             return {
                 "status": "no_data",
                 "message": "No data available. Make a news request first."
             }
 
-        news_data = news_cache[cache_key]
-        sentiment_counts = {"POSITIVE": 0, "NEUTRAL": 0, "NEGATIVE": 0}
-        source_counts = {}
-        symbol_counts = {}
-        total_articles = len(news_data)
-
-        for article in news_data:
-            sentiment_counts[article["sentiment"]] += 1
-            source_counts[article["source"]] = source_counts.get(article["source"], 0) + 1
-            for symbol in article["relatedSymbols"]:
-                symbol_counts[symbol] = symbol_counts.get(symbol, 0) + 1
-
-        return {
-            "total_articles": total_articles,
-            "sentiment_distribution": sentiment_counts,
-            "top_sources": dict(sorted(source_counts.items(), key=lambda x: x[1], reverse=True)[:5]),
-            "top_symbols": dict(sorted(symbol_counts.items(), key=lambda x: x[1], reverse=True)[:5])
-        }
+        return json_response(news_stats)
 
     except Exception as err:
         raise HTTPException(status_code=500, detail=str(err))
 
 if __name__ == "__main__":
+    import importlib.util
+    import logging
     import uvicorn
+    is_production = os.getenv("ENV", "development") == "production"
+    workers = int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1)) if is_production else 1
+    if workers > 1 and isinstance(cache, SimpleMemoryCache):
+        # Per-worker memory caches would split the news cache and the rate limit
+        logging.getLogger("uvicorn.error").warning(
+            "CACHE_URL uses the memory backend; starting 1 worker instead of %d. "
+            "Point CACHE_URL at Redis to run multiple workers.",
+            workers
+        )
+        workers = 1
     uvicorn.run(
         "main:app",
         host="0.0.0.0",
         port=int(os.getenv("PORT", 3000)),
-        reload=True
+        reload=not is_production,
+        workers=workers,
+        # Use uvloop/httptools when installed (uvicorn[standard] skips them on some platforms)
+        loop="uvloop" if importlib.util.find_spec("uvloop") else "asyncio",
+        http="httptools" if importlib.util.find_spec("httptools") else "h11"
     )